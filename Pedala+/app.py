@@ -2,11 +2,15 @@ from flask import Flask, request, jsonify
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import jwt
 from functools import wraps
 import os
 from geopy.distance import geodesic
+from sqlalchemy import delete
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import SQLAlchemyError
 import random
 
 app = Flask(__name__)
@@ -14,9 +18,23 @@ CORS(app)
 
 # Configuration
 app.config['SECRET_KEY'] = 'your-secret-key'  # Change this in production
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///Pedala+.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///Pedala+.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+# Demanda: tamanho da célula espacial (graus) e janelas mantidas por granularidade
+DEMAND_CELL_SIZE = 0.005  # ~500 m
+DEMAND_RETENTION = {
+    'hour': timedelta(hours=48),
+    'day': timedelta(days=30)
+}
+# Janelas seguem o horário de São Paulo: UTC-03:00 fixo (sem horário de verão desde 2019)
+DEMAND_TIMEZONE = timezone(timedelta(hours=-3))
+# Upsert atômico das janelas só existe nestes bancos
+DEMAND_UPSERT = {
+    'sqlite': sqlite_insert,
+    'postgresql': postgresql_insert
+}
+
 db = SQLAlchemy(app)
 
 # Models
@@ -56,6 +74,19 @@ class ScheduledRide(db.Model):
     longitude = db.Column(db.Float, nullable=False)
     date_time = db.Column(db.DateTime, nullable=False)
 
+class DemandWindow(db.Model):
+    # Contagem de inícios/fins de aluguel por célula e janela de tempo
+    id = db.Column(db.Integer, primary_key=True)
+    granularity = db.Column(db.String(10), nullable=False)
+    window_start = db.Column(db.DateTime, nullable=False)
+    cell_lat = db.Column(db.Integer, nullable=False)
+    cell_lon = db.Column(db.Integer, nullable=False)
+    starts = db.Column(db.Integer, nullable=False, default=0)
+    ends = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (
+        db.UniqueConstraint('granularity', 'window_start', 'cell_lat', 'cell_lon'),
+    )
+
 # Authentication decorator
 def token_required(f):
     @wraps(f)
@@ -72,6 +103,65 @@ def token_required(f):
         return f(current_user, *args, **kwargs)
     return decorated
 
+# Demand aggregation
+def window_start_for(timestamp, granularity):
+    # timestamp em UTC (datetime.utcnow); a janela é guardada no horário local
+    local = timestamp.replace(tzinfo=timezone.utc).astimezone(DEMAND_TIMEZONE).replace(tzinfo=None)
+    if granularity == 'hour':
+        return local.replace(minute=0, second=0, microsecond=0)
+    return local.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def record_demand_event(latitude, longitude, timestamp, kind):
+    # Atualiza as janelas (hora e dia) da célula a cada início/fim de aluguel,
+    # para que o endpoint de desequilíbrio não precise ler o histórico de aluguéis
+    upsert = DEMAND_UPSERT.get(db.engine.dialect.name)
+    if not upsert:
+        app.logger.error('Demand aggregation requires SQLite or PostgreSQL, got %s', db.engine.dialect.name)
+        return
+
+    column = 'starts' if kind == 'start' else 'ends'
+    counter = getattr(DemandWindow, column)
+
+    # Falhas na contagem de demanda nunca devem impedir o aluguel
+    try:
+        cell_lat = int(latitude // DEMAND_CELL_SIZE)
+        cell_lon = int(longitude // DEMAND_CELL_SIZE)
+
+        with db.session.begin_nested():
+            for granularity, retention in DEMAND_RETENTION.items():
+                window_start = window_start_for(timestamp, granularity)
+                values = {
+                    'granularity': granularity,
+                    'window_start': window_start,
+                    'cell_lat': cell_lat,
+                    'cell_lon': cell_lon,
+                    'starts': 0,
+                    'ends': 0
+                }
+                values[column] = 1
+
+                # Incremento feito no próprio SQL, sem perder contagens entre requisições simultâneas
+                window = db.session.execute(
+                    upsert(DemandWindow)
+                    .values(values)
+                    .on_conflict_do_update(
+                        index_elements=['granularity', 'window_start', 'cell_lat', 'cell_lon'],
+                        set_={column: counter + 1}
+                    )
+                    .returning(DemandWindow.starts, DemandWindow.ends)
+                ).one()
+
+                # Primeiro evento da janela: descartar as antigas mantém o custo proporcional aos eventos recentes
+                if window.starts + window.ends == 1:
+                    db.session.execute(
+                        delete(DemandWindow).where(
+                            DemandWindow.granularity == granularity,
+                            DemandWindow.window_start < window_start - retention
+                        )
+                    )
+    except (SQLAlchemyError, TypeError, ValueError):
+        app.logger.exception('Failed to record demand event')
+
 # Routes
 @app.route('/api/register', methods=['POST'])
 def register():
@@ -169,10 +259,11 @@ def start_rental(current_user):
     if distance > 100:
         return jsonify({'message': 'Too far from bike'}), 400
     
-    rental = Rental(user_id=current_user.id, bike_id=bike.id)
+    rental = Rental(user_id=current_user.id, bike_id=bike.id, start_time=datetime.utcnow())
     bike.available = False
     
     db.session.add(rental)
+    record_demand_event(bike.latitude, bike.longitude, rental.start_time, 'start')
     db.session.commit()
     
     return jsonify({
@@ -193,14 +284,28 @@ def end_rental(current_user, rental_id):
     if rental.end_time:
         return jsonify({'message': 'Rental already ended'}), 400
     
+    # Posição de devolução (padrão: última posição conhecida da bicicleta)
+    try:
+        latitude = float(data.get('latitude', rental.bike.latitude))
+        longitude = float(data.get('longitude', rental.bike.longitude))
+    except (TypeError, ValueError):
+        return jsonify({'message': 'Invalid drop-off position'}), 400
+    
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return jsonify({'message': 'Invalid drop-off position'}), 400
+    
     rental.end_time = datetime.utcnow()
     rental.bike.available = True
+    rental.bike.latitude = latitude
+    rental.bike.longitude = longitude
     
     # Atualizar pontos e custo
     rental.points = data.get('points', rental.points)
     rental.cost = data.get('cost', 0)
     current_user.points += rental.points
     
+    record_demand_event(rental.bike.latitude, rental.bike.longitude, rental.end_time, 'end')
+    
     db.session.commit()
     
     return jsonify({
@@ -353,6 +458,59 @@ def export_data_for_powerbi(current_user):
     # Retornar JSON para consumo pelo Power BI
     return jsonify(export_data)
 
+@app.route('/api/demand/imbalance', methods=['GET'])
+@token_required
+def get_demand_imbalance(current_user):
+    granularity = request.args.get('granularity', 'hour')
+    if granularity not in DEMAND_RETENTION:
+        return jsonify({'message': 'Invalid granularity'}), 400
+    
+    # Número de janelas a considerar (padrão: últimas 24 horas ou 7 dias)
+    window_size = timedelta(hours=1) if granularity == 'hour' else timedelta(days=1)
+    try:
+        windows = int(request.args.get('windows', 24 if granularity == 'hour' else 7))
+    except ValueError:
+        return jsonify({'message': 'Invalid windows'}), 400
+    max_windows = int(DEMAND_RETENTION[granularity] / window_size)
+    windows = max(1, min(windows, max_windows))
+    
+    current_window = window_start_for(datetime.utcnow(), granularity)
+    since = current_window - window_size * (windows - 1)
+    
+    rows = DemandWindow.query.filter(
+        DemandWindow.granularity == granularity,
+        DemandWindow.window_start >= since
+    ).all()
+    
+    # Somar as janelas de cada célula
+    cells = {}
+    for row in rows:
+        key = (row.cell_lat, row.cell_lon)
+        if key not in cells:
+            cells[key] = {'starts': 0, 'ends': 0}
+        cells[key]['starts'] += row.starts
+        cells[key]['ends'] += row.ends
+    
+    # Desequilíbrio positivo: chegam mais bikes do que saem (excesso de oferta)
+    imbalance = []
+    for (cell_lat, cell_lon), counts in cells.items():
+        imbalance.append({
+            'latitude': round((cell_lat + 0.5) * DEMAND_CELL_SIZE, 6),
+            'longitude': round((cell_lon + 0.5) * DEMAND_CELL_SIZE, 6),
+            'starts': counts['starts'],
+            'ends': counts['ends'],
+            'imbalance': counts['ends'] - counts['starts']
+        })
+    imbalance.sort(key=lambda cell: abs(cell['imbalance']), reverse=True)
+    
+    return jsonify({
+        'granularity': granularity,
+        'since': since.replace(tzinfo=DEMAND_TIMEZONE).isoformat(),
+        'timezone': str(DEMAND_TIMEZONE),
+        'cell_size': DEMAND_CELL_SIZE,
+        'cells': imbalance
+    })
+
 @app.route('/api/profile', methods=['PUT'])
 @token_required
 def update_profile(current_user):
@@ -0,0 +1,175 @@
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+os.environ['DATABASE_URL'] = 'sqlite://'
+
+from app import app, db, Bike, Rental, DemandWindow, record_demand_event, window_start_for
+
+
+@pytest.fixture
+def client():
+    with app.app_context():
+        db.create_all()
+        yield app.test_client()
+        db.session.remove()
+        db.drop_all()
+
+
+def login(client):
+    client.post('/api/register', json={'name': 'Ana', 'email': 'ana@pedala.com', 'password': 'senha'})
+    token = client.post('/api/login', json={'email': 'ana@pedala.com', 'password': 'senha'}).json['token']
+    return {'Authorization': f'Bearer {token}'}
+
+
+def add_bike(latitude, longitude):
+    bike = Bike(name='Bike 1', type='City Bike', latitude=latitude, longitude=longitude)
+    db.session.add(bike)
+    db.session.commit()
+    return bike.id
+
+
+def cells_by_position(response):
+    return {(cell['latitude'], cell['longitude']): cell for cell in response.json['cells']}
+
+
+def test_start_and_end_in_different_cells_have_opposite_imbalance(client):
+    headers = login(client)
+    bike_id = add_bike(-23.5505, -46.6333)
+
+    rental = client.post('/api/rentals/start', json={
+        'bike_id': bike_id,
+        'user_latitude': -23.5505,
+        'user_longitude': -46.6333
+    }, headers=headers).json
+    response = client.post(f"/api/rentals/end/{rental['rental_id']}", json={
+        'latitude': -23.5605,
+        'longitude': -46.6533
+    }, headers=headers)
+    assert response.status_code == 200
+
+    bike = db.session.get(Bike, bike_id)
+    assert (bike.latitude, bike.longitude) == (-23.5605, -46.6533)
+
+    for granularity in ('hour', 'day'):
+        response = client.get(f'/api/demand/imbalance?granularity={granularity}', headers=headers)
+        assert response.status_code == 200
+        assert response.json['timezone'] == 'UTC-03:00'
+        cells = cells_by_position(response)
+        assert sorted(cell['imbalance'] for cell in cells.values()) == [-1, 1]
+        assert sum(cell['starts'] for cell in cells.values()) == 1
+        assert sum(cell['ends'] for cell in cells.values()) == 1
+
+
+def test_end_without_position_uses_bike_position(client):
+    headers = login(client)
+    bike_id = add_bike(-23.5505, -46.6333)
+
+    rental = client.post('/api/rentals/start', json={
+        'bike_id': bike_id,
+        'user_latitude': -23.5505,
+        'user_longitude': -46.6333
+    }, headers=headers).json
+    client.post(f"/api/rentals/end/{rental['rental_id']}", json={}, headers=headers)
+
+    cells = client.get('/api/demand/imbalance', headers=headers).json['cells']
+    assert len(cells) == 1
+    assert (cells[0]['starts'], cells[0]['ends'], cells[0]['imbalance']) == (1, 1, 0)
+
+
+def test_invalid_drop_off_position_is_rejected(client):
+    headers = login(client)
+    bike_id = add_bike(-23.5505, -46.6333)
+
+    rental = client.post('/api/rentals/start', json={
+        'bike_id': bike_id,
+        'user_latitude': -23.5505,
+        'user_longitude': -46.6333
+    }, headers=headers).json
+
+    for position in ({'latitude': None}, {'latitude': 'abc'}, {'latitude': -23.56, 'longitude': 200}):
+        response = client.post(f"/api/rentals/end/{rental['rental_id']}", json=position, headers=headers)
+        assert response.status_code == 400
+
+    bike = db.session.get(Bike, bike_id)
+    assert not bike.available
+    assert (bike.latitude, bike.longitude) == (-23.5505, -46.6333)
+    assert db.session.get(Rental, rental['rental_id']).end_time is None
+
+    response = client.post(f"/api/rentals/end/{rental['rental_id']}", json={
+        'latitude': '-23.5605',
+        'longitude': '-46.6533'
+    }, headers=headers)
+    assert response.status_code == 200
+    assert (bike.latitude, bike.longitude) == (-23.5605, -46.6533)
+
+
+def test_demand_failure_does_not_block_rental(client):
+    headers = login(client)
+    bike_id = add_bike(-23.5505, -46.6333)
+    DemandWindow.__table__.drop(db.engine)
+
+    response = client.post('/api/rentals/start', json={
+        'bike_id': bike_id,
+        'user_latitude': -23.5505,
+        'user_longitude': -46.6333
+    }, headers=headers)
+    assert response.status_code == 200
+    assert Rental.query.count() == 1
+    assert not db.session.get(Bike, bike_id).available
+
+
+def test_repeated_events_increment_the_same_window(client):
+    now = datetime.utcnow()
+    for _ in range(3):
+        record_demand_event(-23.5505, -46.6333, now, 'start')
+    db.session.commit()
+
+    windows = DemandWindow.query.filter_by(granularity='hour').all()
+    assert len(windows) == 1
+    assert (windows[0].starts, windows[0].ends) == (3, 0)
+
+
+def test_invalid_parameters_are_rejected(client):
+    headers = login(client)
+
+    assert client.get('/api/demand/imbalance?granularity=week', headers=headers).status_code == 400
+    assert client.get('/api/demand/imbalance?windows=abc', headers=headers).status_code == 400
+    assert client.get('/api/demand/imbalance').status_code == 401
+
+
+def test_windows_are_clamped_to_retention(client):
+    headers = login(client)
+    current_window = window_start_for(datetime.utcnow(), 'hour')
+
+    response = client.get('/api/demand/imbalance?granularity=hour&windows=1000', headers=headers)
+    since = datetime.fromisoformat(response.json['since']).replace(tzinfo=None)
+    assert since == current_window - timedelta(hours=47)
+
+    response = client.get('/api/demand/imbalance?granularity=hour&windows=0', headers=headers)
+    since = datetime.fromisoformat(response.json['since']).replace(tzinfo=None)
+    assert since == current_window
+
+
+def test_days_are_bucketed_in_local_time():
+    # 02:00 UTC ainda é 23:00 do dia anterior em São Paulo
+    assert window_start_for(datetime(2024, 5, 10, 2, 30), 'day') == datetime(2024, 5, 9)
+    assert window_start_for(datetime(2024, 5, 10, 2, 30), 'hour') == datetime(2024, 5, 9, 23)
+
+
+def test_old_windows_are_pruned_when_a_new_window_opens(client):
+    now = datetime.utcnow()
+    record_demand_event(-23.5505, -46.6333, now - timedelta(days=40), 'start')
+    record_demand_event(-23.5505, -46.6333, now - timedelta(hours=1), 'start')
+    db.session.commit()
+    assert DemandWindow.query.filter_by(granularity='day').count() == 1
+    assert DemandWindow.query.filter_by(granularity='hour').count() == 1
+
+    record_demand_event(-23.5505, -46.6333, now - timedelta(days=5), 'end')
+    record_demand_event(-23.5505, -46.6333, now + timedelta(hours=1), 'end')
+    db.session.commit()
+    hour_windows = DemandWindow.query.filter_by(granularity='hour').all()
+    assert len(hour_windows) == 2
+    assert all(window.window_start > window_start_for(now, 'hour') - timedelta(hours=48)
+               for window in hour_windows)